@@ -5,13 +5,24 @@ import argparse
 import progressbar
 import tabulate
 from getkey import getkey
-from digikam import Digikam
+from digikam import Digikam, Telemetry
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+# argparse type for options that need a count of at least 1
+def positiveInt(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer: %s" % value)
+    return number
+
+
 parser = argparse.ArgumentParser(description="Create Digikam Tags for Camera and Lens")
 parser.add_argument(
     "path", metavar="PATH", type=str, help="relative album path or substring"
@@ -22,6 +33,28 @@ parser.add_argument(
     action="store_true",
     help="match on AlbumRoot label (includes all Albums)",
 )
+parser.add_argument(
+    "-f",
+    "--filter",
+    dest="filter",
+    choices=["auto", "exists", "set", "temp"],
+    default="auto",
+    help="how to skip images already tagged: correlated NOT EXISTS, id set filtered in Python, or temporary table anti-join. Default 'auto' picks one by the number of images in path",
+)
+parser.add_argument(
+    "-b",
+    "--batch",
+    dest="batch",
+    type=positiveInt,
+    help="commit every BATCH images in short transactions and retry on lock waits and deadlocks, for use while Digikam is running. Changes are committed as they are made",
+)
+parser.add_argument(
+    "-m",
+    "--metrics",
+    dest="metrics",
+    type=str,
+    help="write run metrics to this file, Prometheus textfile if it ends with '.prom' otherwise JSON",
+)
 if len(sys.argv) == 1:
     parser.print_help(sys.stderr)
     sys.exit(1)
@@ -30,6 +63,15 @@ args = parser.parse_args()
 digikam = Digikam()
 config = digikam.config.tags()
 db = digikam.db()
+telemetry = Telemetry("digikam-camera-tags", interval=10)
+telemetry.attach(db)
+telemetry.phase("load")
+
+
+def writeMetrics():
+    if args.metrics:
+        telemetry.write(args.metrics)
+
 
 if args.album_root:
     # find AlbumRoot matching path:
@@ -59,10 +101,14 @@ paths = cur.fetchall()
 print(tabulate.tabulate(paths))
 
 print("Continue (y/n) ? ")
+telemetry.pause()
 s = getkey()
 if s != "y":
+    telemetry.count("aborted")
+    writeMetrics()
     sys.exit(-1)
 print("Loading...")
+telemetry.phase("load")
 
 # find Tag ids for root
 root_camera = config["root_camera"]
@@ -95,7 +141,10 @@ def fetchTag(name, pid=None):
 
 def createTag(name, pid):
     sql = "INSERT INTO `Tags` (`name`, `pid`) VALUES (%(name)s, %(pid)s)"
-    cur = db.execute(sql, {"name": name, "pid": pid})
+    # in write mode commit the tag on its own, a replayed batch would change its id
+    db.flush()
+    cur = db.write(sql, {"name": name, "pid": pid})
+    db.flush()
     new_tags_list.append((cur.lastrowid, pid, name))
     # TagsTree records are created by a Trigger on Tags table
     return cur.lastrowid
@@ -111,7 +160,7 @@ def fetchOrCreateTag(name, pid):
 
 def addImageTag(imageid, tagid):
     sql = "INSERT INTO `ImageTags` (`imageid`, `tagid`) VALUES (%(imageid)s, %(tagid)s)"
-    cur = db.execute(sql, {"imageid": imageid, "tagid": tagid})
+    cur = db.write(sql, {"imageid": imageid, "tagid": tagid})
     return cur
 
 
@@ -123,6 +172,100 @@ except Exception as e:
     sys.exit(3)
 
 
+roots = (
+    root_camera_tag_id,
+    root_lens_tag_id,
+)
+
+# up to this many images in path a correlated NOT EXISTS probe per image
+# is cheaper than reading the tagged ids of the whole path
+EXISTS_FILTER_LIMIT = 1000
+# largest number of tagged image ids to load into a Python set,
+# beyond this the anti-join is done in a temporary table
+SET_FILTER_LIMIT = 200000
+# rows per INSERT when filling the temporary table
+TEMP_INSERT_ROWS = 1000
+
+# images in path, an upper bound on both the candidates and the
+# tagged images, counted from the Images album index
+sqlPathCount = """
+SELECT COUNT(*) AS cnt
+FROM `Images` i
+INNER JOIN (
+    SELECT a.* FROM `Albums` a
+    INNER JOIN `AlbumRoots` r ON r.id = a.albumRoot
+    WHERE {sqlPathWhere}
+) a ON a.id = i.album
+""".format(
+    sqlPathWhere=sql_path_where
+)
+
+# images in path with existing tags under these roots
+sqlTagged = """
+SELECT DISTINCT it.imageid
+FROM `ImageTags` it
+INNER JOIN `Tags` t ON t.id = it.tagid
+INNER JOIN `TagsTree` tt ON tt.id = t.id
+INNER JOIN `Images` i ON i.id = it.imageid
+INNER JOIN (
+    SELECT a.* FROM `Albums` a
+    INNER JOIN `AlbumRoots` r ON r.id = a.albumRoot
+    WHERE {sqlPathWhere}
+) a ON a.id = i.album
+WHERE tt.pid IN %(roots)s
+""".format(
+    sqlPathWhere=sql_path_where
+)
+
+strategy = args.filter
+if strategy == "auto":
+    cur = db.execute(sqlPathCount, {"path": sql_path_val})
+    count = cur.fetchone()["cnt"]
+    if count <= EXISTS_FILTER_LIMIT:
+        strategy = "exists"
+    elif count <= SET_FILTER_LIMIT:
+        strategy = "set"
+    else:
+        strategy = "temp"
+telemetry.count("filter_" + strategy)
+
+tagged = set()
+sql_tagged_join = ""
+sql_tagged_where = ""
+if strategy == "exists":
+    sql_tagged_where = """
+AND NOT EXISTS (
+    SELECT it.imageid
+    FROM `ImageTags` it
+    INNER JOIN `Tags` t ON t.id = it.tagid
+    INNER JOIN `TagsTree` tt ON tt.id = t.id
+    WHERE
+        imageid = i.id
+        AND tt.pid IN %(roots)s
+)"""
+elif strategy == "temp":
+    # CREATE ... SELECT would be a locking read of ImageTags, Tags and TagsTree
+    # held until commit, so read the ids with a plain SELECT and insert them
+    cur = db.execute(sqlTagged, {"path": sql_path_val, "roots": roots})
+    ids = [row["imageid"] for row in cur]
+    telemetry.count("tagged_images", len(ids))
+    db.execute(
+        "CREATE TEMPORARY TABLE `tagged_images` (`imageid` INT NOT NULL PRIMARY KEY)"
+    )
+    for n in range(0, len(ids), TEMP_INSERT_ROWS):
+        chunk = ids[n : n + TEMP_INSERT_ROWS]
+        db.execute(
+            "INSERT INTO `tagged_images` (`imageid`) VALUES "
+            + ",".join(["(%s)"] * len(chunk)),
+            chunk,
+        )
+    sql_tagged_join = "LEFT JOIN `tagged_images` ti ON ti.imageid = i.id"
+    sql_tagged_where = "AND ti.imageid IS NULL"
+else:
+    cur = db.execute(sqlTagged, {"path": sql_path_val, "roots": roots})
+    tagged = set(row["imageid"] for row in cur)
+    telemetry.count("tagged_images", len(tagged))
+
 # ignore any photos with existing tags under these roots
 # videos do not have ImageMetadata
 sql = """
@@ -139,30 +282,22 @@ INNER JOIN (
     INNER JOIN `AlbumRoots` r ON r.id = a.albumRoot
     WHERE {sqlPathWhere}
 ) a ON a.id = i.album
+{sqlTaggedJoin}
 WHERE 1=1
 AND im.make IS NOT NULL
 AND im.model IS NOT NULL
-AND NOT EXISTS (
-    SELECT it.imageid
-    FROM `ImageTags` it
-    INNER JOIN `Tags` t ON t.id = it.tagid
-    INNER JOIN `TagsTree` tt ON tt.id = t.id
-    WHERE
-        imageid = i.id
-        AND tt.pid IN %(roots)s
-)
+{sqlTaggedWhere}
 ORDER BY a.relativePath, i.album
 """.format(
-    sqlPathWhere=sql_path_where
+    sqlPathWhere=sql_path_where,
+    sqlTaggedJoin=sql_tagged_join,
+    sqlTaggedWhere=sql_tagged_where,
 )
 cur = db.execute(
     sql,
     {
         "path": sql_path_val,
-        "roots": (
-            root_camera_tag_id,
-            root_lens_tag_id,
-        ),
+        "roots": roots,
     },
 )
 ## tabulate named fields https://github.com/astanin/python-tabulate/issues/36#issue-553238535
@@ -174,10 +309,11 @@ cur = db.execute(
 # print(table(rows, ["name", "make", "model", "lens"]))
 
 
-images = cur.fetchall()
+images = [i for i in cur if i["id"] not in tagged]
 
 if not images:
     print("No untagged images found.")
+    writeMetrics()
     sys.exit(0)
 
 
@@ -247,6 +383,7 @@ def decodeMetadata(metadata, makes):
     }
 
 
+telemetry.phase("decode")
 images = [{**i, **decodeMetadata(i, makes)} for i in images]
 print(tabulate.tabulate(images, headers="keys", tablefmt="psql"))
 
@@ -263,6 +400,12 @@ lens_base_id = None
 lens_id = None
 print("")
 print("Processing Images")
+telemetry.total = len(images)
+telemetry.phase("write")
+if args.batch:
+    db.batch(args.batch)
+# print telemetry progress lines above the progressbar
+progressbar.streams.wrap_stderr()
 for image in progressbar.progressbar(images):
     if image["make"] and image["model"]:
         if image["make"] != prev_image["make"]:
@@ -272,9 +415,6 @@ for image in progressbar.progressbar(images):
         if image["make"] != prev_image["make"] or image["model"] != prev_image["model"]:
             model_id = fetchOrCreateTag(image["model"], camera_base_id)["id"]
 
-        # addImageTag(image["id"], root_camera_tag_id)
-        # addImageTag(image["id"], camera_base_id)
-        addImageTag(image["id"], model_id)
         if image["lens"]:
             if not lens_base_id or image["make"] != prev_image["make"]:
                 lens_base = image["make"] + " Lens"
@@ -285,15 +425,28 @@ for image in progressbar.progressbar(images):
                 or image["lens"] != prev_image["lens"]
             ):
                 lens_id = fetchOrCreateTag(image["lens"], lens_base_id)["id"]
+        else:
+            lens_base_id = None
+            lens_id = None
 
+        # tags are created before tagging the image, in write mode creating a
+        # tag commits the batch which must not hold half of this image's tags
+        # addImageTag(image["id"], root_camera_tag_id)
+        # addImageTag(image["id"], camera_base_id)
+        addImageTag(image["id"], model_id)
+        telemetry.count("image_tags")
+        if image["lens"]:
             # if root_lens_tag_id != root_camera_tag_id:
             #    addImageTag(image["id"], root_lens_tag_id)
             # addImageTag(image["id"], lens_base_id)
             addImageTag(image["id"], lens_id)
-        else:
-            lens_base_id = None
-            lens_id = None
+            telemetry.count("image_tags")
     prev_image = image
+    db.item_done()
+    telemetry.tick()
+telemetry.count("new_tags", len(new_tags_list))
+telemetry.pause()
+progressbar.streams.unwrap_stderr()
 
 
 # confirm for any new models or makes added to DB
@@ -304,11 +457,19 @@ print(
         [{"Num": i + 1, "Name": new_tags_list[i]} for i in range(len(new_tags_list))]
     )
 )
-print("Commit changes (y/n) ? ")
-s = getkey()
-if s != "y":
-    db.rollback()
-    db.close()
-    sys.exit(-1)
+# batches have already been committed in write mode
+if not args.batch:
+    print("Commit changes (y/n) ? ")
+    s = getkey()
+    if s != "y":
+        db.rollback()
+        db.close()
+        telemetry.count("aborted")
+        writeMetrics()
+        sys.exit(-1)
+telemetry.phase("commit")
 db.commit()
 db.close()
+telemetry.count("lock_errors", db.lock_errors)
+telemetry.report()
+writeMetrics()
@@ -1,14 +1,71 @@
 #!/usr/bin/env python3
 
+import re
 import sys
 import argparse
-from digikam import Digikam
+from digikam import Digikam, Telemetry
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+# argparse type for options that need a count of at least 1
+def positiveInt(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer: %s" % value)
+    return number
+
+
+# read ignore patterns from file, one per line
+# blank lines and lines starting with '#' are skipped
+# lines starting with 're:' are regular expressions, others are substrings
+def readIgnoreFile(filename):
+    strings = []
+    regexes = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if line.startswith("re:"):
+                regexes.append(line[3:])
+            else:
+                strings.append(line)
+    return strings, regexes
+
+
+# compile ignore patterns into a function returning True for ignored names,
+# None if there are none
+# strings are combined into a single regex, regexes are compiled separately
+# so their inline flags and backreferences keep working
+def compileIgnore(strings, regexes, flags=0):
+    patterns = []
+    if strings:
+        patterns.append(re.compile("|".join(re.escape(s) for s in strings), flags))
+    patterns += [re.compile(r, flags) for r in regexes]
+    if not patterns:
+        return None
+    return lambda name: any(p.search(name) for p in patterns)
+
+
+# True if the column compares case-insensitively, as LIKE and GROUP BY on it do
+def caseInsensitive(db, table, column):
+    sql = """
+SELECT COLLATION_NAME FROM information_schema.COLUMNS
+WHERE TABLE_SCHEMA = DATABASE()
+AND TABLE_NAME = %(table)s
+AND COLUMN_NAME = %(column)s
+"""
+    row = db.execute(sql, {"table": table, "column": column}).fetchone()
+    collation = row["COLLATION_NAME"] if row else None
+    return bool(collation) and not collation.endswith("_bin")
+
+
 parser = argparse.ArgumentParser(description="Create Digikam Groups")
 parser.add_argument(
     "path", metavar="PATH", type=str, help="relative album path or substring"
@@ -29,6 +86,13 @@ parser.add_argument(
     help="merge maximum rating to all items in group",
 )
 parser.add_argument("-c", "--commit", action="store_true", help="commit to database")
+parser.add_argument(
+    "-b",
+    "--batch",
+    dest="batch",
+    type=positiveInt,
+    help="with -c, commit every BATCH groups in short transactions and retry on lock waits and deadlocks, for use while Digikam is running",
+)
 parser.add_argument(
     "-s",
     "--separator",
@@ -45,6 +109,21 @@ parser.add_argument(
     type=str,
     help="ignore filenames containing this string from becoming a prefix. This argument can be repeated multiple times.",
 )
+parser.add_argument(
+    "-I",
+    "--ignore-regex",
+    dest="ignore_regex",
+    action="append",
+    type=str,
+    help="ignore filenames matching this regular expression. This argument can be repeated multiple times.",
+)
+parser.add_argument(
+    "--ignore-from",
+    dest="ignore_from",
+    action="append",
+    type=str,
+    help="read ignore strings from FILE, one per line. Lines starting with 're:' are regular expressions",
+)
 parser.add_argument(
     "-g",
     "--group-version",
@@ -59,21 +138,56 @@ parser.add_argument(
     action="store_true",
     help="delete groups for all images found in path. Default only deletes images that are put into new groups",
 )
+parser.add_argument(
+    "-m",
+    "--metrics",
+    dest="metrics",
+    type=str,
+    help="write run metrics to this file, Prometheus textfile if it ends with '.prom' otherwise JSON",
+)
 
 if len(sys.argv) == 1:
     parser.print_help(sys.stderr)
     sys.exit(1)
 
 args = parser.parse_args()
+ignoreStrings = list(args.ignore or [])
+ignoreRegexes = list(args.ignore_regex or [])
+try:
+    for filename in args.ignore_from or []:
+        strings, regexes = readIgnoreFile(filename)
+        ignoreStrings += strings
+        ignoreRegexes += regexes
+except OSError as e:
+    eprint(e)
+    sys.exit(2)
 digikam = Digikam()
 db = digikam.db()
+# follow the collation of Images.name like the previous NOT LIKE filter did
+nameCaseInsensitive = caseInsensitive(db, "Images", "name")
+try:
+    ignore = compileIgnore(
+        ignoreStrings, ignoreRegexes, re.IGNORECASE if nameCaseInsensitive else 0
+    )
+except re.error as e:
+    eprint("Invalid ignore regex: {0}".format(e))
+    sys.exit(2)
+telemetry = Telemetry("digikam-group", interval=10)
+telemetry.attach(db)
+if args.batch and args.commit:
+    db.batch(args.batch)
+elif args.batch:
+    eprint("Ignoring -b without -c, nothing is committed")
 groupType = "2"
 if args.group_version:
     groupType = "1"
 
 # find all unique name prefixes
+# without ignore patterns the prefixes are grouped by the database,
+# otherwise names are returned and filtered as rows are read
 sqlGroups = """
  SELECT SUBSTRING_INDEX(i.`name`, %(separator)s, '1') as namePrefix,
+{name}
 i.`album`,
 a.`relativePath`
 FROM Images i
@@ -81,18 +195,13 @@ INNER JOIN (
   SELECT * FROM Albums a
   WHERE a.`relativePath` like %(path)s
 ) a ON a.`id` = i.`album`
-WHERE 1=1
-{where}
-GROUP BY namePrefix, i.`album`
+{groupBy}
 ORDER BY i.`album`, namePrefix;
 """
-if args.ignore:
-    where = ""
-    for i in args.ignore:
-        where += "AND i.`name` NOT LIKE '%%{0}%%'".format(db.escape_like(i))
-    sqlGroups = sqlGroups.format(where=where)
+if ignore:
+    sqlGroups = sqlGroups.format(name="i.`name`,", groupBy="")
 else:
-    sqlGroups = sqlGroups.format(where="")
+    sqlGroups = sqlGroups.format(name="", groupBy="GROUP BY namePrefix, i.`album`")
 # find all files with matching prefix
 # order by should put JPG before all other file types
 sqlGroup = """
@@ -105,16 +214,8 @@ SUBSTRING_INDEX(i.`name`, '.','-1') as nameExt
 FROM Images i
 WHERE i.`album`=%(album)s
 AND i.`name` LIKE %(match)s
-{where}
 ORDER BY namePrefix, nameFull, FIELD(nameExt,'JPG') desc;
 """
-if args.ignore:
-    where = ""
-    for i in args.ignore:
-        where += "AND i.`name` NOT LIKE '%%{0}%%'".format(db.escape_like(i))
-    sqlGroup = sqlGroup.format(where=where)
-else:
-    sqlGroup = sqlGroup.format(where="")
 
 sqlGroupDelete = """
 DELETE FROM ImageRelations
@@ -163,13 +264,28 @@ INSERT IGNORE INTO ImageTags (
 );
 """
 
+telemetry.phase("load")
 cur = db.execute(
     sqlGroups,
     {"separator": args.separator, "path": "%" + db.escape_like(args.path) + "%"},
 )
 
 groups = []
+seen = set()
 for row in cur:
+    if ignore:
+        if ignore(row["name"]):
+            continue
+        # skip prefixes already added for this album, case is folded here and
+        # any other collation equality (accents, trailing spaces) is caught
+        # by the image set check below
+        prefix = row["namePrefix"]
+        if nameCaseInsensitive:
+            prefix = prefix.lower()
+        key = (row["album"], prefix)
+        if key in seen:
+            continue
+        seen.add(key)
     groups.append(
         {
             "prefix": row["namePrefix"],
@@ -178,11 +294,17 @@ for row in cur:
         }
     )
 
+telemetry.total = len(groups)
 path = ""
+album = None
 for group in groups:
+    telemetry.phase("load")
     if path != group["path"]:
         print(group["path"])  # relativePath
         path = group["path"]
+    if album != group["album"]:
+        # image sets of the groups processed in this album
+        processed = set()
     prefix = group["prefix"]
     album = group["album"]
     cur = db.execute(
@@ -191,13 +313,21 @@ for group in groups:
     )
     imgs = []
     for row in cur:
+        if ignore and ignore(row["name"]):
+            continue
         imgs.append({"id": row["id"], "name": row["name"]})
         # print(" - {0}".format(row))
     ids = list(str(i["id"]) for i in imgs)  # get ids from imgs
+    # prefixes equal under the column collation find the same images
+    if frozenset(ids) in processed:
+        telemetry.tick()
+        continue
+    processed.add(frozenset(ids))
+    telemetry.phase("write")
     if args.delete_groups or len(imgs) > 1:
         # purge items from any existing grouping
         # sql = sqlGroupDelete.format(ids = ",".join(ids))
-        cur = db.execute(sqlGroupDelete, {"type": groupType, "ids": ids})
+        cur = db.write(sqlGroupDelete, {"type": groupType, "ids": ids})
     if len(imgs) > 1:
         sql = sqlGroupIns
         subs = imgs.copy()
@@ -214,7 +344,9 @@ for group in groups:
             )
             # print("\t - {0}".format(img["name"]))
         sql += ",\n".join(ins)
-        cur = db.execute(sql)
+        cur = db.write(sql)
+        telemetry.count("groups")
+        telemetry.count("grouped_images", len(imgs))
         # update ratings
         if args.ratings:
             # sql = sqlRating.format(ids=obj["id"])
@@ -224,7 +356,7 @@ for group in groups:
             print("\t  Updating rating: {0}".format(rating))
             subIds = list(str(i["id"]) for i in subs)
             # sql = sqlRatingsUpdate.format(rating=rating,ids=",".join(ids))
-            cur = db.execute(sqlRatingsUpdate, {"rating": rating, "ids": ids})
+            cur = db.write(sqlRatingsUpdate, {"rating": rating, "ids": ids})
         # clone tags from parent
         if args.tags:
             print("\t  Cloning parent's tags")
@@ -243,7 +375,7 @@ for group in groups:
                 # copy tags
                 if extra == False:
                     # sql = sqlTagsClone.format(obj=obj["id"],sub=img["id"])
-                    cur = db.execute(sqlTagsClone, {"obj": obj["id"], "sub": img["id"]})
+                    cur = db.write(sqlTagsClone, {"obj": obj["id"], "sub": img["id"]})
         if args.all:
             print("\t  Merging all tags")
             # sql = sqlRating.format(ids=",".join(ids))
@@ -253,16 +385,23 @@ for group in groups:
             print("\t  Updating rating: {0}".format(rating))
             subIds = list(str(i["id"]) for i in subs)
             # sql = sqlRatingsUpdate.format(rating=rating,ids=",".join(ids))
-            cur = db.execute(sqlRatingsUpdate, {"rating": rating, "ids": ids})
+            cur = db.write(sqlRatingsUpdate, {"rating": rating, "ids": ids})
             for id in ids:
                 # sql = sqlTagsCloneAll.format(id=id, ids=",".join(ids))
-                cur = db.execute(sqlTagsCloneAll, {"id": id, "ids": ids})
+                cur = db.write(sqlTagsCloneAll, {"id": id, "ids": ids})
+    db.item_done()
+    telemetry.tick()
 
 if len(groups) > 0:
     if args.commit:
         eprint("Committing changes to database")
+        telemetry.phase("commit")
         db.commit()
     else:
         eprint("")
         eprint("Run script with -c switch to save to database")
 db.close()
+telemetry.count("lock_errors", db.lock_errors)
+telemetry.report()
+if args.metrics:
+    telemetry.write(args.metrics)
@@ -3,15 +3,35 @@
 # Check the consistency of Digikam's Tags table
 # prints nothing if consistent
 # prints inconsistent tags if found
+#
+# A fingerprint of the Tags and TagsTree tables is cached together with the
+# last result. If neither table has changed the cached result is reported,
+# otherwise only the subtrees containing changed tags are verified again.
 
 import sys
+import json
 import argparse
 from digikam import Digikam
 
+CACHE_VERSION = 1
+
 parser = argparse.ArgumentParser(description="Check Digikam Tags Tree")
 parser.add_argument(
     "-q", "--quiet", action="store_true", help="quiet, don't output if tree ok"
 )
+parser.add_argument(
+    "--cache",
+    dest="cache",
+    default="digikam-tags-check.cache",
+    type=str,
+    help="file to store the last verified result, default is 'digikam-tags-check.cache'",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="ignore the cache and verify every tag",
+)
 
 args = parser.parse_args()
 
@@ -19,10 +39,109 @@ digikam = Digikam()
 db = digikam.db()
 db2 = digikam.db()
 
+
+def loadCache(filename, database):
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != CACHE_VERSION or cache.get("database") != database:
+        return None
+    return cache
+
+
+def saveCache(filename, cache):
+    try:
+        with open(filename, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print("Unable to write cache: {0}".format(e), file=sys.stderr)
+
+
+def fingerprint():
+    # cheap server-side summary of both tables, compared before any bulk read
+    result = {}
+    for table in ("Tags", "TagsTree"):
+        cur = db.execute(
+            "SELECT COUNT(*) AS cnt, MAX(id) AS maxId FROM `{0}`".format(table)
+        )
+        row = cur.fetchone()
+        cur = db.execute("CHECKSUM TABLE `{0}`".format(table))
+        checksum = cur.fetchone()["Checksum"]
+        result[table] = [row["cnt"], row["maxId"], checksum]
+    return result
+
+
+def printResult(errors):
+    if errors:
+        print(
+            """
+INCONSISTENT TAGS TREE
+"""
+        )
+        for tag in errors:
+            print(tag)
+
+    elif not args.quiet:
+        print("No errors found")
+
+
+database = "{host}:{port}/{db}".format(**digikam.config.database())
+cache = None if args.force else loadCache(args.cache, database)
+current = fingerprint()
+
+if cache and cache["fingerprint"] == current:
+    printResult(cache["errors"])
+    db.close()
+    db2.close()
+    sys.exit(0)
+
 sql = "SELECT id, pid, name FROM Tags WHERE id <> 0"
 cur = db.execute(sql)
 tags = cur.fetchall()
 
+sqlTreeAll = """
+SELECT id, pid
+FROM TagsTree
+ORDER BY id, pid
+"""
+cur = db.execute(sqlTreeAll)
+tree = {}
+for row in cur:
+    tree.setdefault(str(row["id"]), []).append(row["pid"])
+
+parents = {str(tag["id"]): tag["pid"] for tag in tags}
+
+if cache:
+    # tags whose parent or TagsTree entries differ from the last run
+    changed = set(
+        id
+        for id in parents
+        if parents[id] != cache["parents"].get(id)
+        or tree.get(id) != cache["tree"].get(id)
+    )
+    # moving a tag changes the ancestry of its whole subtree
+    children = {}
+    for tag in tags:
+        children.setdefault(str(tag["pid"]), []).append(str(tag["id"]))
+    # children of deleted tags keep their pid but lose their ancestry
+    removed = cache["parents"].keys() - parents.keys()
+    for id in removed:
+        changed.update(children.get(id, []))
+    pending = list(changed)
+    while pending:
+        for child in children.get(pending.pop(), []):
+            if child not in changed:
+                changed.add(child)
+                pending.append(child)
+    # carry forward errors for tags that were not re-verified
+    previous = set(str(tag["id"]) for tag in cache["errors"])
+    unchanged_errors = set(id for id in previous if id not in changed)
+else:
+    changed = set(parents)
+    unchanged_errors = set()
+
 sqlAncestor = """
 WITH RECURSIVE ancestors (id, pid) AS (
    SELECT id, pid
@@ -33,7 +152,7 @@ WITH RECURSIVE ancestors (id, pid) AS (
    FROM Tags c
      JOIN ancestors p ON p.pid = c.id
      WHERE c.id <> 0 -- prevent root tag
-) 
+)
 SELECT *
 FROM ancestors
 ORDER BY pid
@@ -48,6 +167,10 @@ ORDER BY pid
 
 errors = []
 for tag in tags:
+    if str(tag["id"]) not in changed:
+        if str(tag["id"]) in unchanged_errors:
+            errors.append(tag)
+        continue
     curA = db.execute(sqlAncestor, {"id": tag["id"]})
     tagsA = curA.fetchall()
     curT = db.execute(sqlTree, {"id": tag["id"]})
@@ -61,17 +184,19 @@ for tag in tags:
             errors.append(tag)
             break
 
-if errors:
-    print(
-        """
-INCONSISTENT TAGS TREE
-"""
-    )
-    for tag in errors:
-        print(tag)
+printResult(errors)
 
-elif not args.quiet:
-    print("No errors found")
+saveCache(
+    args.cache,
+    {
+        "version": CACHE_VERSION,
+        "database": database,
+        "fingerprint": current,
+        "parents": parents,
+        "tree": tree,
+        "errors": errors,
+    },
+)
 
 db.close()
 db2.close()
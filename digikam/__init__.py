@@ -1,3 +1,4 @@
 from .config_module import Config
 from .database_module import Database
+from .telemetry_module import Telemetry
 from .digikam_module import Digikam
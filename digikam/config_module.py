@@ -15,6 +15,10 @@ class Config:
             "user": config["DATABASE"]["USER"],
             "passwd": config["DATABASE"]["PASS"],
             "db": config["DATABASE"]["NAME"],
+            # optional settings for Database.batch()
+            "isolation": config["DATABASE"].get("ISOLATION", "READ COMMITTED"),
+            "lock_wait_timeout": config["DATABASE"].getint("LOCK_WAIT_TIMEOUT", 10),
+            "retries": config["DATABASE"].getint("RETRIES", 5),
         }
 
     def tags(self):
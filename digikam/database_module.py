@@ -1,6 +1,16 @@
 import pymysql
+import random
+import time
 import warnings
 
+# ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK
+LOCK_ERRORS = (1205, 1213)
+# seconds to wait before the first retry, doubled on each further retry
+RETRY_BACKOFF = 0.1
+# bounds for the delay between batches while other clients are waiting on locks
+THROTTLE_MIN = 0.05
+THROTTLE_MAX = 5.0
+
 
 class Database:
     def __init__(self, config):
@@ -17,6 +27,18 @@ class Database:
         warnings.filterwarnings("ignore", category=pymysql.Warning)
         self.conn = conn
         self.cur = self.conn.cursor(pymysql.cursors.DictCursor)
+        # number of queries executed, read by Telemetry
+        self.queries = 0
+        # write mode settings, see batch()
+        self.isolation = config.get("isolation")
+        self.lock_wait_timeout = config.get("lock_wait_timeout")
+        self.retries = config.get("retries", 5)
+        self.batch_size = 0
+        self.lock_errors = 0
+        self.delay = 0.0
+        self._batch = []
+        self._items = 0
+        self._lock_waits = 0
 
     # escape special characters for LIKE queries
     def escape_like(self, sql):
@@ -25,20 +47,127 @@ class Database:
     # wrap execute to catch SQL errors
     def execute(self, sql, args=None):
         try:
-            # store sql and args incase we want to inspect with sql()
-            self._last_sql = sql
-            self._last_args = args
-            self.cur.execute(sql, args)
+            self._execute(sql, args)
             return self.cur
         except pymysql.Error as err:
-            print(err)
-            print(self.sql())
-            exit()
+            self._fail(err)
 
-    def commit(self):
+    def _execute(self, sql, args):
+        # store sql and args incase we want to inspect with sql()
+        self._last_sql = sql
+        self._last_args = args
+        self.queries += 1
+        self.cur.execute(sql, args)
+
+    def _fail(self, err):
+        print(err)
+        print(self.sql())
+        exit()
+
+    # enable write mode for running alongside other clients:
+    # write() statements are committed in short transactions every size items,
+    # items are marked by item_done() so a batch never holds part of an item,
+    # a batch failing on a lock wait timeout or deadlock is rolled back and
+    # replayed with backoff, and batches are spaced out while the server
+    # reports new row lock waits
+    # ends the current transaction
+    def batch(self, size):
         self.conn.commit()
+        if self.isolation:
+            self.execute("SET SESSION TRANSACTION ISOLATION LEVEL " + self.isolation)
+        if self.lock_wait_timeout:
+            self.execute(
+                "SET SESSION innodb_lock_wait_timeout = %s", (self.lock_wait_timeout,)
+            )
+        self.batch_size = size
+        self._lock_waits = self._row_lock_waits()
+
+    # execute a statement that modifies data
+    # same as execute() unless write mode is enabled
+    def write(self, sql, args=None):
+        if not self.batch_size:
+            return self.execute(sql, args)
+        self._batch.append((sql, args))
+        self._attempt(self._batch[-1:])
+        return self.cur
+
+    # mark the end of an item's writes, commits every batch_size items
+    def item_done(self):
+        if not self.batch_size:
+            return
+        self._items += 1
+        if self._items >= self.batch_size:
+            self.flush()
+
+    # commit the current batch in write mode
+    def flush(self):
+        if not self.batch_size:
+            return
+        self._attempt([], commit=True)
+        self._batch = []
+        self._items = 0
+        self._throttle()
+
+    def _attempt(self, statements, commit=False):
+        for attempt in range(self.retries + 1):
+            try:
+                for sql, args in statements:
+                    self._execute(sql, args)
+                if commit:
+                    self.conn.commit()
+                return
+            except pymysql.err.OperationalError as err:
+                if err.args[0] not in LOCK_ERRORS or attempt == self.retries:
+                    self._fail(err)
+                self.lock_errors += 1
+                self.conn.rollback()
+                self._slowdown()
+                time.sleep(RETRY_BACKOFF * 2**attempt * (1 + random.random()))
+                # the rollback discarded the whole batch, replay it
+                statements = self._batch
+            except pymysql.Error as err:
+                self._fail(err)
+
+    def _throttle(self):
+        waits = self._row_lock_waits()
+        if waits > self._lock_waits:
+            self._slowdown()
+        else:
+            self.delay /= 2
+            if self.delay < THROTTLE_MIN:
+                self.delay = 0.0
+        self._lock_waits = waits
+        if self.delay:
+            time.sleep(self.delay)
+
+    def _slowdown(self):
+        self.delay = min(max(self.delay * 2, THROTTLE_MIN), THROTTLE_MAX)
+
+    # server wide count of row lock waits, includes other clients waiting on us
+    def _row_lock_waits(self):
+        sql = "SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_waits'"
+        try:
+            # separate cursor to keep lastrowid of self.cur
+            with self.conn.cursor(pymysql.cursors.DictCursor) as cur:
+                self._last_sql = sql
+                self._last_args = None
+                self.queries += 1
+                cur.execute(sql)
+                row = cur.fetchone()
+        except pymysql.Error as err:
+            self._fail(err)
+        return int(row["Value"]) if row else 0
+
+    def commit(self):
+        if self.batch_size:
+            self.flush()
+        else:
+            self.conn.commit()
 
+    # in write mode only the current batch is rolled back
     def rollback(self):
+        self._batch = []
+        self._items = 0
         self.conn.rollback()
 
     def close(self):
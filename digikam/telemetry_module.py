@@ -0,0 +1,191 @@
+import json
+import os
+import sys
+import time
+
+
+# track per-phase timings and item counters for a script run
+# time is accounted to the current phase until phase() switches to the next one
+# pause() stops the clock, e.g. while waiting for user input
+# tick() counts processed items and prints throughput and ETA every interval seconds
+class Telemetry:
+    def __init__(self, name, total=None, interval=None, stream=None):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.items = 0
+        self.counters = {}
+        self.phases = {}
+        self._db = None
+        self._phase = None
+        self._phase_start = None
+        self._paused = None
+        self._idle = 0.0
+        self._start = time.monotonic()
+        self._last_report = self._start
+        self._finished = None
+
+    # count queries run by this connection
+    def attach(self, db):
+        self._db = db
+
+    @property
+    def queries(self):
+        return self._db.queries if self._db else 0
+
+    def phase(self, name):
+        now = time.monotonic()
+        self._stop_phase(now)
+        self._resume(now)
+        self._phase = name
+        self._phase_start = now
+        self.phases.setdefault(name, 0.0)
+
+    def _stop_phase(self, now):
+        if self._phase is not None:
+            self.phases[self._phase] += now - self._phase_start
+            self._phase = None
+
+    def pause(self):
+        if self._paused is None:
+            self._paused = time.monotonic()
+            self._stop_phase(self._paused)
+
+    def _resume(self, now):
+        if self._paused is not None:
+            self._idle += now - self._paused
+            self._paused = None
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def tick(self, n=1):
+        self.items += n
+        if self.interval is None:
+            return
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self._print(self.progress(now))
+
+    # stderr is looked up on each call so a wrapped stream, e.g. by
+    # progressbar.streams.wrap_stderr(), is used
+    def _print(self, line):
+        print(line, file=self.stream or sys.stderr)
+
+    def elapsed(self, now=None):
+        if self._finished is not None:
+            now = self._finished
+        return (now or time.monotonic()) - self._start - self._idle
+
+    def eta(self, now=None):
+        if not self.total or not self.items:
+            return None
+        rate = self.items / self.elapsed(now)
+        return max(self.total - self.items, 0) / rate
+
+    def progress(self, now=None):
+        elapsed = self.elapsed(now)
+        line = "{0}".format(self.items)
+        if self.total:
+            line += "/{0}".format(self.total)
+        line += " items, {0:.1f} items/s, {1:.1f} queries/s".format(
+            self.items / elapsed, self.queries / elapsed
+        )
+        eta = self.eta(now)
+        if eta is not None:
+            line += ", ETA {0}".format(time.strftime("%H:%M:%S", time.gmtime(eta)))
+        if self._phase:
+            line += " [{0}]".format(self._phase)
+        return line
+
+    def finish(self):
+        if self._finished is None:
+            self._finished = time.monotonic()
+            self._stop_phase(self._finished)
+            self._resume(self._finished)
+
+    def summary(self):
+        self.finish()
+        elapsed = self.elapsed()
+        return {
+            "script": self.name,
+            "timestamp": int(time.time()),
+            "duration_seconds": round(elapsed, 3),
+            "items": self.items,
+            "items_per_second": round(self.items / elapsed, 3) if elapsed else 0.0,
+            "queries": self.queries,
+            "queries_per_second": round(self.queries / elapsed, 3) if elapsed else 0.0,
+            "phases": {k: round(v, 3) for k, v in self.phases.items()},
+            "counters": dict(self.counters),
+        }
+
+    def report(self):
+        summary = self.summary()
+        self._print(
+            "{items} items in {duration_seconds}s ({items_per_second} items/s, "
+            "{queries} queries, {queries_per_second} queries/s)".format(**summary)
+        )
+        for name, seconds in summary["phases"].items():
+            self._print("  {0}: {1}s".format(name, seconds))
+        for name, value in summary["counters"].items():
+            self._print("  {0}: {1}".format(name, value))
+
+    # write a Prometheus textfile if filename ends with .prom, otherwise JSON
+    def write(self, filename):
+        summary = self.summary()
+        if filename.endswith(".prom"):
+            content = self._prometheus(summary)
+        else:
+            content = json.dumps(summary, indent=2) + "\n"
+        # write to a temporary file so collectors never read a partial file
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, filename)
+
+    def _prometheus(self, summary):
+        script = 'script="{0}"'.format(summary["script"])
+        lines = []
+
+        def metric(name, help, value):
+            lines.append("# HELP digikam_{0} {1}".format(name, help))
+            lines.append("# TYPE digikam_{0} gauge".format(name))
+            lines.append("digikam_{0}{{{1}}} {2}".format(name, script, value))
+
+        metric(
+            "run_timestamp_seconds", "Unix time the run finished.", summary["timestamp"]
+        )
+        metric("run_duration_seconds", "Total run time.", summary["duration_seconds"])
+        metric("run_items", "Items processed.", summary["items"])
+        metric(
+            "run_items_per_second",
+            "Items processed per second.",
+            summary["items_per_second"],
+        )
+        metric("run_queries", "SQL queries executed.", summary["queries"])
+        metric(
+            "run_queries_per_second",
+            "SQL queries executed per second.",
+            summary["queries_per_second"],
+        )
+        if summary["phases"]:
+            lines.append("# HELP digikam_run_phase_seconds Time spent in each phase.")
+            lines.append("# TYPE digikam_run_phase_seconds gauge")
+            for name, seconds in summary["phases"].items():
+                lines.append(
+                    'digikam_run_phase_seconds{{{0},phase="{1}"}} {2}'.format(
+                        script, name, seconds
+                    )
+                )
+        if summary["counters"]:
+            lines.append("# HELP digikam_run_counter Script specific counters.")
+            lines.append("# TYPE digikam_run_counter gauge")
+            for name, value in summary["counters"].items():
+                lines.append(
+                    'digikam_run_counter{{{0},counter="{1}"}} {2}'.format(
+                        script, name, value
+                    )
+                )
+        return "\n".join(lines) + "\n"